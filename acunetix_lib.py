@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+acunetix_lib.py
+
+Helpers shared by the Acunetix scripts (and the Dojo client in process_nmap_ips_for_pt.py).
+Lives next to them in /opt/tools so a plain `import acunetix_lib` resolves from the script directory.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is used when it is not installed
+    orjson = None
+
+
+# ---------- JSON / output ----------
+
+def json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any, indent: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else 0)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None).encode("utf-8")
+
+
+def emit(result: Any, output: Optional[str] = None, pretty: bool = False) -> None:
+    data = json_dumps(result)
+    if output:
+        with open(output, "wb") as f:
+            f.write(json_dumps(result, indent=True) if pretty else data)
+    sys.stdout.buffer.write(data + b"\n")
+
+
+# ---------- HTTP ----------
+
+class ApiRetry(Retry):
+    # A POST creates a scan, group, target or product; a 5xx after the server accepted it must not
+    # replay it. 429/503 are refusals before any work was done, so those are the only POSTs resent.
+    POST_RETRY_STATUSES = frozenset({429, 503})
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if method.upper() == "POST":
+            return status_code in self.POST_RETRY_STATUSES
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+def make_retry() -> Retry:
+    kwargs: Dict[str, Any] = {
+        "total": 5,
+        "backoff_factor": 0.5,
+        "status_forcelist": [429, 500, 502, 503, 504],
+        # POST stays out of allowed_methods so read timeouts are not replayed; ApiRetry handles its statuses.
+        "allowed_methods": frozenset({"GET", "HEAD", "PATCH"}),
+        "respect_retry_after_header": True,
+        "raise_on_status": False,
+    }
+    try:
+        return ApiRetry(backoff_jitter=0.3, **kwargs)
+    except TypeError:  # urllib3 < 2.0 has no backoff_jitter
+        return ApiRetry(**kwargs)
+
+
+def make_session(
+    verify: bool = False, pool: int = 32, headers: Optional[Dict[str, str]] = None, retries: bool = True
+) -> requests.Session:
+    s = requests.Session()
+    s.verify = verify
+    if headers:
+        s.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=pool, pool_maxsize=pool, max_retries=make_retry() if retries else 0)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def dojo_headers(token: str) -> Dict[str, str]:
+    return {
+        "Authorization": f"Token {token}",
+        "Accept": "application/json",
+        "Content-Type": "application/json",
+    }
+
+
+def acu_headers(token: str) -> Dict[str, str]:
+    return {
+        "X-Auth": token,
+        "Accept": "application/json",
+        "Content-Type": "application/json",
+    }
+
+
+# ---------- Acunetix target groups ----------
+
+def acu_list_groups(s: requests.Session, base: str, timeout: int) -> List[Dict[str, Any]]:
+    r = s.get(f"{base}/api/v1/target_groups?limit=100", timeout=timeout)
+    r.raise_for_status()
+    return json_loads(r.content).get("groups", [])
+
+
+def acu_index_groups(groups: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    return {g.get("name"): g for g in groups}
+
+
+def groups_cache_path(base: str, token: str) -> str:
+    key = hashlib.sha256(f"{base}|{token}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(tempfile.gettempdir(), f"acu_groups_{key}.json")
+
+
+def write_groups_cache(path: str, groups: List[Dict[str, Any]]) -> None:
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix="acu_groups_", suffix=".tmp", dir=os.path.dirname(path))
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(json_dumps(groups))
+        os.replace(tmp_path, path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+
+
+def invalidate_groups_cache(base: str, token: str) -> None:
+    with contextlib.suppress(OSError):
+        os.unlink(groups_cache_path(base, token))
+
+
+def acu_list_groups_cached(
+    s: requests.Session, base: str, token: str, timeout: int, ttl: int, refresh: bool = False
+) -> List[Dict[str, Any]]:
+    path = groups_cache_path(base, token)
+    if ttl > 0 and not refresh:
+        try:
+            if time.time() - os.path.getmtime(path) < ttl:
+                with open(path, "rb") as f:
+                    return json_loads(f.read())
+        except (OSError, ValueError):
+            pass
+    groups = acu_list_groups(s, base, timeout)
+    if ttl > 0:
+        write_groups_cache(path, groups)
+    return groups
+
+
+def acu_resolve_group(
+    s: requests.Session, base: str, token: str, name: str, timeout: int, ttl: int
+) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+    groups = acu_list_groups_cached(s, base, token, timeout, ttl)
+    group = acu_index_groups(groups).get(name)
+    if group is None and ttl > 0:
+        # The cached listing may predate the group; confirm against the API before treating it as missing.
+        groups = acu_list_groups_cached(s, base, token, timeout, ttl, refresh=True)
+        group = acu_index_groups(groups).get(name)
+    return group, groups
@@ -2,57 +2,79 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import json
+import concurrent.futures
 import os
 import sys
+from dataclasses import asdict, dataclass, field
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Set
+from typing import Any, Dict, List, Optional, Set
 
 import requests
 import urllib3
 
+from acunetix_lib import acu_headers, acu_resolve_group, dojo_headers, emit, json_loads, make_session
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 STAGE = "WF_D"
-ACTIVE_SCAN_STATUSES = {"queued", "processing", "starting", "scheduled"}
+ACTIVE_SCAN_STATUSES = frozenset({"queued", "processing", "starting", "scheduled"})
+_EMPTY: Dict[str, Any] = {}
 
 
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
-def result_contract(pt_id: int, status: str, ok: bool = True) -> Dict[str, Any]:
-    ts = now_iso()
-    return {
-        "ok": ok,
-        "stage": STAGE,
-        "product_type_id": pt_id,
-        "status": status,
-        "metrics": {},
-        "errors": [],
-        "warnings": [],
-        "timestamps": {"started_at": ts, "finished_at": ts},
-    }
+@dataclass(slots=True)
+class ScanResult:
+    ok: bool = True
+    stage: str = STAGE
+    product_type_id: Optional[int] = None
+    status: str = "success"
+    metrics: Dict[str, Any] = field(default_factory=dict)
+    errors: List[Any] = field(default_factory=list)
+    warnings: List[Any] = field(default_factory=list)
+    timestamps: Dict[str, str] = field(default_factory=dict)
 
 
-def headers_dojo(token: str) -> Dict[str, str]:
-    return {"Authorization": f"Token {token}", "Accept": "application/json", "Content-Type": "application/json"}
+def result_contract(pt_id: int, status: str, ok: bool = True) -> ScanResult:
+    ts = now_iso()
+    return ScanResult(ok=ok, product_type_id=pt_id, status=status, timestamps={"started_at": ts, "finished_at": ts})
 
 
-def headers_acu(token: str) -> Dict[str, str]:
-    return {"X-Auth": token, "Accept": "application/json", "Content-Type": "application/json"}
+def get_json(session: requests.Session, url: str, timeout: int) -> Dict[str, Any]:
+    r = session.get(url, timeout=timeout)
+    r.raise_for_status()
+    return json_loads(r.content)
 
 
-def get_json(session: requests.Session, url: str, headers: Dict[str, str], timeout: int) -> Dict[str, Any]:
-    r = session.get(url, headers=headers, timeout=timeout)
+def post_json(session: requests.Session, url: str, payload: Dict[str, Any], timeout: int) -> Dict[str, Any]:
+    r = session.post(url, json=payload, timeout=timeout)
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
+
+
+def start_scan(
+    session: requests.Session,
+    base: str,
+    target_id: str,
+    profile_id: str,
+    incremental: bool,
+    timeout: int,
+) -> Dict[str, Any]:
+    payload = {
+        "target_id": target_id,
+        "profile_id": profile_id,
+        "incremental": incremental,
+        "schedule": {"disable": False, "start_date": None, "time_sensitive": False},
+    }
+    created = post_json(session, f"{base}/api/v1/scans", payload, timeout)
+    return {"target_id": target_id, "scan_id": created.get("scan_id")}
 
 
-def post_json(session: requests.Session, url: str, headers: Dict[str, str], payload: Dict[str, Any], timeout: int) -> Dict[str, Any]:
-    r = session.post(url, headers=headers, json=payload, timeout=timeout)
-    r.raise_for_status()
-    return r.json()
+def scan_status(scan: Dict[str, Any]) -> str:
+    session = scan.get("current_session") or _EMPTY
+    return (session.get("status") or scan.get("status") or "unknown").lower()
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -65,6 +87,8 @@ def build_parser() -> argparse.ArgumentParser:
     p.add_argument("--scan-profile-id", default=os.environ.get("ACUNETIX_SCAN_PROFILE_ID", "11111111-1111-1111-1111-111111111111"))
     p.add_argument("--incremental", action="store_true")
     p.add_argument("--timeout", type=int, default=30)
+    p.add_argument("--groups-cache-ttl", type=int, default=300, help="Seconds to reuse the cached target_groups listing (0 disables)")
+    p.add_argument("--concurrency", type=int, default=8, help="Max scans created in parallel")
     p.add_argument("--dry-run", action="store_true")
     return p
 
@@ -72,99 +96,107 @@ def build_parser() -> argparse.ArgumentParser:
 def main() -> int:
     args = build_parser().parse_args()
     out = result_contract(args.product_type_id, "error", ok=False)
-    out["timestamps"]["started_at"] = now_iso()
+    out.timestamps["started_at"] = now_iso()
 
     if not all([args.dojo_base_url, args.dojo_token, args.acu_base_url, args.acu_token]):
-        out["errors"].append({"code": "missing_required"})
-        print(json.dumps(out, ensure_ascii=False))
+        out.errors.append({"code": "missing_required"})
+        emit(asdict(out))
         return 2
 
     try:
-        s = requests.Session()
-        s.verify = False
-
-        pt = get_json(
-            s,
-            f"{args.dojo_base_url.rstrip('/')}/product_types/{args.product_type_id}/",
-            headers_dojo(args.dojo_token),
-            args.timeout,
-        )
+        dojo_base = args.dojo_base_url.rstrip("/")
+        acu_base = args.acu_base_url.rstrip("/")
+        dojo_s = make_session(verify=False, headers=dojo_headers(args.dojo_token))
+        acu_s = make_session(verify=False, pool=max(32, args.concurrency * 4), headers=acu_headers(args.acu_token))
+
+        pt = get_json(dojo_s, f"{dojo_base}/product_types/{args.product_type_id}/", args.timeout)
         pt_name = pt.get("name") or f"PT-{args.product_type_id}"
 
-        groups = get_json(s, f"{args.acu_base_url.rstrip('/')}/api/v1/target_groups?limit=100", headers_acu(args.acu_token), args.timeout).get("groups", [])
-        group = next((g for g in groups if g.get("name") == pt_name), None)
+        group, _ = acu_resolve_group(acu_s, acu_base, args.acu_token, pt_name, args.timeout, args.groups_cache_ttl)
         if not group:
-            out["ok"] = True
-            out["status"] = "skipped"
-            out["warnings"].append("group_not_found")
-            out["timestamps"]["finished_at"] = now_iso()
-            print(json.dumps(out, ensure_ascii=False))
+            out.ok = True
+            out.status = "skipped"
+            out.warnings.append("group_not_found")
+            out.timestamps["finished_at"] = now_iso()
+            emit(asdict(out))
             return 0
 
         group_id = group.get("group_id")
-        target_ids = get_json(s, f"{args.acu_base_url.rstrip('/')}/api/v1/target_groups/{group_id}/targets", headers_acu(args.acu_token), args.timeout).get("target_id_list", [])
+        target_ids = get_json(acu_s, f"{acu_base}/api/v1/target_groups/{group_id}/targets", args.timeout).get("target_id_list", [])
         if not target_ids:
-            out["ok"] = True
-            out["status"] = "skipped"
-            out["warnings"].append("no_targets")
-            out["metrics"].update({"group_id": group_id})
-            out["timestamps"]["finished_at"] = now_iso()
-            print(json.dumps(out, ensure_ascii=False))
+            out.ok = True
+            out.status = "skipped"
+            out.warnings.append("no_targets")
+            out.metrics.update({"group_id": group_id})
+            out.timestamps["finished_at"] = now_iso()
+            emit(asdict(out))
             return 0
 
-        scans = get_json(s, f"{args.acu_base_url.rstrip('/')}/api/v1/scans?c=100", headers_acu(args.acu_token), args.timeout).get("scans", [])
+        scans = get_json(acu_s, f"{acu_base}/api/v1/scans?c=100", args.timeout).get("scans", [])
         target_set: Set[str] = set(target_ids)
         active = []
         for scan in scans:
-            status = (scan.get("current_session", {}) or {}).get("status") or scan.get("status")
-            tid = scan.get("target_id") or (scan.get("target", {}) or {}).get("target_id")
-            if tid in target_set and str(status).lower() in ACTIVE_SCAN_STATUSES:
+            tid = scan.get("target_id") or (scan.get("target") or _EMPTY).get("target_id")
+            if tid not in target_set:
+                continue
+            status = scan_status(scan)
+            if status in ACTIVE_SCAN_STATUSES:
                 active.append({"scan_id": scan.get("scan_id"), "target_id": tid, "status": status})
 
-        out["metrics"].update({"group_id": group_id, "targets_count": len(target_ids), "active_scans_count": len(active)})
+        out.metrics.update({"group_id": group_id, "targets_count": len(target_ids), "active_scans_count": len(active)})
         if active:
-            out["ok"] = True
-            out["status"] = "already_running"
-            out["warnings"].append("scan_guard_triggered")
-            out["metrics"]["active_scans"] = active
-            out["timestamps"]["finished_at"] = now_iso()
-            print(json.dumps(out, ensure_ascii=False))
+            out.ok = True
+            out.status = "already_running"
+            out.warnings.append("scan_guard_triggered")
+            out.metrics["active_scans"] = active
+            out.timestamps["finished_at"] = now_iso()
+            emit(asdict(out))
             return 0
 
         if args.dry_run:
-            out["ok"] = True
-            out["status"] = "success"
-            out["metrics"]["dry_run"] = True
-            out["timestamps"]["finished_at"] = now_iso()
-            print(json.dumps(out, ensure_ascii=False))
+            out.ok = True
+            out.status = "success"
+            out.metrics["dry_run"] = True
+            out.timestamps["finished_at"] = now_iso()
+            emit(asdict(out))
             return 0
 
-        started = []
-        for tid in target_ids:
-            payload = {
-                "target_id": tid,
-                "profile_id": args.scan_profile_id,
-                "incremental": bool(args.incremental),
-                "schedule": {"disable": False, "start_date": None, "time_sensitive": False},
+        started: List[Dict[str, Any]] = []
+        failed: List[Dict[str, Any]] = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as ex:
+            futures = {
+                ex.submit(start_scan, acu_s, acu_base, tid, args.scan_profile_id, bool(args.incremental), args.timeout): tid
+                for tid in target_ids
             }
-            created = post_json(s, f"{args.acu_base_url.rstrip('/')}/api/v1/scans", headers_acu(args.acu_token), payload, args.timeout)
-            started.append({"target_id": tid, "scan_id": created.get("scan_id")})
-
-        out["ok"] = True
-        out["status"] = "success"
-        out["metrics"]["started_scans_count"] = len(started)
-        out["metrics"]["started_scans"] = started
-        out["timestamps"]["finished_at"] = now_iso()
-        print(json.dumps(out, ensure_ascii=False))
-        return 0
+            # One failed POST must not hide the scans the other workers already started.
+            for fut in concurrent.futures.as_completed(futures):
+                try:
+                    started.append(fut.result())
+                except Exception as exc:
+                    failed.append({"target_id": futures[fut], "error": str(exc)})
+
+        out.ok = not failed
+        out.status = "success" if not failed else ("partial" if started else "error")
+        out.metrics["started_scans_count"] = len(started)
+        out.metrics["started_scans"] = started
+        out.metrics["failed_scans_count"] = len(failed)
+        out.metrics["failed_scans"] = failed
+        if failed:
+            out.errors.append({"code": "start_scan_failed", "details": failed})
+        out.timestamps["finished_at"] = now_iso()
+        emit(asdict(out))
+        return 0 if out.ok else 1
     except Exception as exc:
-        out["ok"] = False
-        out["status"] = "error"
-        out["errors"].append({"code": "unexpected_error", "details": str(exc)})
-        out["timestamps"]["finished_at"] = now_iso()
-        print(json.dumps(out, ensure_ascii=False))
+        out.ok = False
+        out.status = "error"
+        out.errors.append({"code": "unexpected_error", "details": str(exc)})
+        out.timestamps["finished_at"] = now_iso()
+        emit(asdict(out))
         return 1
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    code = main()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
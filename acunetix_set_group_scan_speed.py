@@ -2,73 +2,82 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import json
+import concurrent.futures
 import os
 import sys
 import traceback
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import requests
 import urllib3
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
+from acunetix_lib import acu_headers, acu_resolve_group, emit, json_loads, make_session
 
-def make_session(verify: bool = False) -> requests.Session:
-    s = requests.Session()
-    s.verify = verify
-    return s
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
 def log(level: str, message: str) -> None:
     print(f"{level}: {message}", file=sys.stderr)
 
 
-def acu_headers(token: str) -> Dict[str, str]:
-    return {
-        "X-Auth": token,
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-    }
-
-
 def safe_json(resp: requests.Response) -> Any:
     try:
-        return resp.json()
-    except Exception:
+        return json_loads(resp.content)
+    except ValueError:
         return {"_raw": resp.text[:500]}
 
 
-def acu_list_groups(s: requests.Session, base_url: str, token: str, timeout: int) -> List[Dict[str, Any]]:
-    r = s.get(f"{base_url.rstrip('/')}/api/v1/target_groups?limit=100", headers=acu_headers(token), timeout=timeout)
+def acu_get_group_targets(s: requests.Session, base: str, group_id: str, timeout: int) -> List[str]:
+    r = s.get(f"{base}/api/v1/target_groups/{group_id}/targets", timeout=timeout)
     r.raise_for_status()
-    return r.json().get("groups", [])
+    return json_loads(r.content).get("target_id_list", [])
 
 
-def acu_find_group_by_name(groups: List[Dict[str, Any]], name: str) -> Optional[Dict[str, Any]]:
-    for g in groups:
-        if g.get("name") == name:
-            return g
-    return None
+def acu_get_target_configuration(s: requests.Session, base: str, target_id: str, timeout: int) -> Dict[str, Any]:
+    r = s.get(f"{base}/api/v1/targets/{target_id}/configuration", timeout=timeout)
+    r.raise_for_status()
+    return json_loads(r.content)
 
 
-def acu_get_group_targets(s: requests.Session, base_url: str, token: str, group_id: str, timeout: int) -> List[str]:
-    r = s.get(f"{base_url.rstrip('/')}/api/v1/target_groups/{group_id}/targets", headers=acu_headers(token), timeout=timeout)
-    r.raise_for_status()
-    return r.json().get("target_id_list", [])
+def acu_set_target_scan_speed(s: requests.Session, base: str, target_id: str, scan_speed: str, timeout: int) -> requests.Response:
+    payload = {"scan_speed": scan_speed}
+    return s.patch(f"{base}/api/v1/targets/{target_id}/configuration", json=payload, timeout=timeout)
 
 
-def acu_get_target_configuration(s: requests.Session, base_url: str, token: str, target_id: str, timeout: int) -> Dict[str, Any]:
-    r = s.get(f"{base_url.rstrip('/')}/api/v1/targets/{target_id}/configuration", headers=acu_headers(token), timeout=timeout)
-    r.raise_for_status()
-    return r.json()
+def acu_bulk_set_scan_speed(s: requests.Session, base: str, target_ids: List[str], scan_speed: str, timeout: int) -> requests.Response:
+    payload = {"target_id_list": target_ids, "configuration": {"scan_speed": scan_speed}}
+    return s.patch(f"{base}/api/v1/targets/configuration", json=payload, timeout=timeout)
 
 
-def acu_set_target_scan_speed(
-    s: requests.Session, base_url: str, token: str, target_id: str, scan_speed: str, timeout: int
-) -> requests.Response:
-    payload = {"scan_speed": scan_speed}
-    return s.patch(f"{base_url.rstrip('/')}/api/v1/targets/{target_id}/configuration", headers=acu_headers(token), json=payload, timeout=timeout)
+def check_one(s: requests.Session, base: str, target_id: str, scan_speed: str, timeout: int) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+    try:
+        cfg = acu_get_target_configuration(s, base, target_id, timeout)
+    except Exception as e:
+        return "error", target_id, {"target_id": target_id, "error": str(e)}
+    if cfg.get("scan_speed") == scan_speed:
+        return "skipped", target_id, None
+    return "pending", target_id, None
+
+
+def patch_one(s: requests.Session, base: str, target_id: str, scan_speed: str, timeout: int) -> Tuple[str, str, Optional[Dict[str, Any]]]:
+    try:
+        r = acu_set_target_scan_speed(s, base, target_id, scan_speed, timeout)
+    except Exception as e:
+        return "error", target_id, {"target_id": target_id, "error": str(e)}
+    if r.status_code not in (200, 204):
+        return "error", target_id, {"target_id": target_id, "status": r.status_code, "response": safe_json(r)}
+    return "changed", target_id, None
+
+
+def map_targets(
+    fn: Callable[[str], Tuple[str, str, Optional[Dict[str, Any]]]], target_ids: List[str], concurrency: int
+) -> Dict[str, List[Any]]:
+    # Buckets target ids by outcome; the "error" bucket holds error dicts instead.
+    buckets: Dict[str, List[Any]] = {"changed": [], "skipped": [], "pending": [], "error": []}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
+        for outcome, tid, err in ex.map(fn, target_ids):
+            buckets[outcome].append(err if outcome == "error" else tid)
+    return buckets
 
 
 def build_parser() -> argparse.ArgumentParser:
@@ -80,7 +89,11 @@ def build_parser() -> argparse.ArgumentParser:
     group.add_argument("--group-name", dest="group_name")
     ap.add_argument("--scan-speed", dest="scan_speed", default="sequential")
     ap.add_argument("--timeout", type=int, default=30)
+    ap.add_argument("--groups-cache-ttl", type=int, default=300, help="Seconds to reuse the cached target_groups listing (0 disables)")
+    ap.add_argument("--concurrency", type=int, default=16, help="Max targets updated in parallel")
     ap.add_argument("--output", help="Optional path to write result JSON")
+    ap.add_argument("--pretty", action="store_true", help="Indent the --output file")
+    ap.add_argument("--force", action="store_true", help="Skip the per-target GET and PATCH every target")
     ap.add_argument("--dry-run", action="store_true")
     return ap
 
@@ -90,10 +103,10 @@ def main() -> int:
 
     if not args.base_url or not args.token:
         log("ERROR", "base-url/token are required")
-        print(json.dumps({"ok": False, "error": "missing_required"}, ensure_ascii=False))
+        emit({"ok": False, "error": "missing_required"})
         return 2
     if args.timeout <= 0:
-        print(json.dumps({"ok": False, "error": "invalid_timeout"}, ensure_ascii=False))
+        emit({"ok": False, "error": "invalid_timeout"})
         return 2
 
     debug: Dict[str, Any] = {
@@ -102,24 +115,23 @@ def main() -> int:
         "group_name_arg": args.group_name,
         "scan_speed": args.scan_speed,
         "dry_run": bool(args.dry_run),
+        "force": bool(args.force),
         "timeout": args.timeout,
+        "concurrency": args.concurrency,
     }
 
     try:
-        s = make_session(verify=False)
+        base = args.base_url.rstrip("/")
+        s = make_session(verify=False, pool=max(32, args.concurrency), headers=acu_headers(args.token))
         group_id = args.group_id
         group_info: Optional[Dict[str, Any]] = None
 
         if not group_id:
-            groups = acu_list_groups(s, args.base_url, args.token, args.timeout)
-            g = acu_find_group_by_name(groups, args.group_name)
+            g, groups = acu_resolve_group(s, base, args.token, args.group_name, args.timeout, args.groups_cache_ttl)
             debug["groups_total"] = len(groups)
             if not g:
                 result = {"ok": False, "error": "group_not_found", "details": f"Group with name '{args.group_name}' not found", "debug": debug}
-                if args.output:
-                    with open(args.output, "w", encoding="utf-8") as f:
-                        json.dump(result, f, ensure_ascii=False, indent=2)
-                print(json.dumps(result, ensure_ascii=False))
+                emit(result, args.output, args.pretty)
                 return 1
             group_id = g.get("group_id")
             group_info = g
@@ -132,38 +144,41 @@ def main() -> int:
         debug["group_id"] = group_id
         debug["group_info"] = group_info
 
-        target_ids = acu_get_group_targets(s, args.base_url, args.token, group_id, args.timeout)
+        target_ids = acu_get_group_targets(s, base, group_id, args.timeout)
         debug["targets_in_group_count"] = len(target_ids)
 
         if not target_ids:
             result = {"ok": True, "warning": "no_targets_in_group", "group_id": group_id, "scan_speed": args.scan_speed, "targets_total": 0, "debug": debug}
-            if args.output:
-                with open(args.output, "w", encoding="utf-8") as f:
-                    json.dump(result, f, ensure_ascii=False, indent=2)
-            print(json.dumps(result, ensure_ascii=False))
+            emit(result, args.output, args.pretty)
             return 0
 
+        if args.force:
+            checked: Dict[str, List[Any]] = {"pending": list(target_ids), "skipped": [], "error": []}
+        else:
+            checked = map_targets(lambda tid: check_one(s, base, tid, args.scan_speed, args.timeout), target_ids, args.concurrency)
+        pending: List[str] = checked["pending"]
+        skipped: List[str] = checked["skipped"]
+        errors: List[Dict[str, Any]] = checked["error"]
         changed: List[str] = []
-        skipped: List[str] = []
-        errors: List[Dict[str, Any]] = []
 
-        for tid in target_ids:
+        if args.dry_run:
+            changed = pending
+        elif pending:
+            # Probe the bulk endpoint once, without retry backoff: older Acunetix versions lack it.
+            probe_s = make_session(verify=False, pool=1, headers=acu_headers(args.token), retries=False)
             try:
-                cfg = acu_get_target_configuration(s, args.base_url, args.token, tid, args.timeout)
-                current = cfg.get("scan_speed")
-                if current == args.scan_speed:
-                    skipped.append(tid)
-                    continue
-                if args.dry_run:
-                    changed.append(tid)
-                    continue
-                r = acu_set_target_scan_speed(s, args.base_url, args.token, tid, args.scan_speed, args.timeout)
-                if r.status_code not in (200, 204):
-                    errors.append({"target_id": tid, "status": r.status_code, "response": safe_json(r)})
-                else:
-                    changed.append(tid)
-            except Exception as e:
-                errors.append({"target_id": tid, "error": str(e)})
+                bulk_status: Optional[int] = acu_bulk_set_scan_speed(probe_s, base, pending, args.scan_speed, args.timeout).status_code
+            except requests.RequestException as e:
+                bulk_status = None
+                debug["bulk_update_error"] = str(e)
+            debug["bulk_update_status"] = bulk_status
+            if bulk_status in (200, 204):
+                changed = pending
+            else:
+                # Bulk endpoint missing or failing: PATCH target by target.
+                patched = map_targets(lambda tid: patch_one(s, base, tid, args.scan_speed, args.timeout), pending, args.concurrency)
+                changed = patched["changed"]
+                errors.extend(patched["error"])
 
         result = {
             "ok": len(errors) == 0,
@@ -179,22 +194,19 @@ def main() -> int:
             "debug": debug,
         }
 
-        if args.output:
-            with open(args.output, "w", encoding="utf-8") as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
-        print(json.dumps(result, ensure_ascii=False))
+        emit(result, args.output, args.pretty)
         return 0 if result["ok"] else 1
 
     except Exception as e:
         debug["exception"] = str(e)
         debug["traceback"] = traceback.format_exc()
         result = {"ok": False, "error": "unexpected_error", "details": str(e), "debug": debug}
-        if args.output:
-            with open(args.output, "w", encoding="utf-8") as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
-        print(json.dumps(result, ensure_ascii=False))
+        emit(result, args.output, args.pretty)
         return 1
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    code = main()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
@@ -2,20 +2,36 @@
 # -*- coding: utf-8 -*-
 
 import argparse
-import json
+import concurrent.futures
+import functools
 import os
+import re
 import sys
 import traceback
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional, Set
+from urllib.parse import urlsplit
 
 import requests
 import urllib3
 
+from acunetix_lib import (
+    acu_headers,
+    acu_resolve_group,
+    dojo_headers,
+    emit,
+    invalidate_groups_cache,
+    json_loads,
+    make_session,
+)
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 STAGE = "WF_C"
 
+_HAS_DIGIT = re.compile(r"\d")
+_TRUE_STRINGS = frozenset({"1", "true", "yes", "y", "on"})
+
 
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
@@ -35,52 +51,70 @@ def make_result(product_type_id: int, status: str, ok: bool = True) -> Dict[str,
     }
 
 
-def make_session(verify: bool) -> requests.Session:
-    s = requests.Session()
-    s.verify = verify
-    return s
-
-
-def dojo_headers(token: str) -> Dict[str, str]:
-    return {
-        "Authorization": f"Token {token}",
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-    }
-
-
-def dojo_get_product_type(s: requests.Session, base_url: str, token: str, pt_id: int, timeout: int) -> Dict[str, Any]:
-    r = s.get(f"{base_url.rstrip('/')}/product_types/{pt_id}/", headers=dojo_headers(token), timeout=timeout)
+def dojo_get_product_type(s: requests.Session, base: str, pt_id: int, timeout: int) -> Dict[str, Any]:
+    r = s.get(f"{base}/product_types/{pt_id}/", timeout=timeout)
     r.raise_for_status()
-    return r.json()
-
-
-def dojo_get_products_for_pt(s: requests.Session, base_url: str, token: str, pt_id: int, timeout: int) -> List[Dict[str, Any]]:
-    r = s.get(f"{base_url.rstrip('/')}/products/?prod_type={pt_id}&limit=1000", headers=dojo_headers(token), timeout=timeout)
-    r.raise_for_status()
-    return r.json().get("results", [])
+    return json_loads(r.content)
+
+
+def dojo_get_products_for_pt(
+    s: requests.Session,
+    base: str,
+    pt_id: int,
+    timeout: int,
+    page_size: int = 1000,
+    concurrency: int = 8,
+) -> List[Dict[str, Any]]:
+    def fetch_page(offset: int) -> Dict[str, Any]:
+        r = s.get(
+            f"{base}/products/?prod_type={pt_id}&internet_accessible=true&limit={page_size}&offset={offset}",
+            timeout=timeout,
+        )
+        r.raise_for_status()
+        return json_loads(r.content)
+
+    first = fetch_page(0)
+    products: List[Dict[str, Any]] = list(first.get("results", []))
+    offsets = range(page_size, int(first.get("count") or 0), page_size)
+    if offsets:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
+            for page in ex.map(fetch_page, offsets):
+                products.extend(page.get("results", []))
+    return products
 
 
 def normalize_bool(val: Any) -> bool:
     if isinstance(val, bool):
         return val
     if isinstance(val, str):
-        return val.strip().lower() in ("1", "true", "yes", "y", "on")
+        return val.strip().lower() in _TRUE_STRINGS
     if isinstance(val, (int, float)):
         return bool(val)
     return False
 
 
+@functools.lru_cache(maxsize=4096)
 def normalize_target_url(name: str) -> str:
     n = (name or "").strip().lower()
     if not n:
         return ""
-    if n.startswith("http://") or n.startswith("https://"):
+    if n.startswith(("http://", "https://")):
         return n
-    if any(ch.isdigit() for ch in n) and ":" in n and " " not in n:
+    if ":" in n and " " not in n and _HAS_DIGIT.search(n):
         return f"http://{n}"
-    bare = n[4:] if n.startswith("www.") else n
-    return f"https://{bare}"
+    return f"https://{n.removeprefix('www.')}"
+
+
+@functools.lru_cache(maxsize=4096)
+def target_key(url: str) -> str:
+    # Canonical form used to compare targets: explicit default port, no trailing slash.
+    try:
+        parts = urlsplit(url if "://" in url else f"https://{url}")
+        scheme = parts.scheme or "https"
+        port = parts.port or (80 if scheme == "http" else 443)
+    except ValueError:
+        return url
+    return f"{scheme}://{parts.hostname or ''}:{port}{parts.path.rstrip('/')}"
 
 
 def build_targets_from_products(products: List[Dict[str, Any]]) -> List[str]:
@@ -90,64 +124,103 @@ def build_targets_from_products(products: List[Dict[str, Any]]) -> List[str]:
         if not normalize_bool(prod.get("internet_accessible")):
             continue
         url = normalize_target_url(prod.get("name") or "")
-        if url and url not in seen:
-            seen.add(url)
+        if not url:
+            continue
+        key = target_key(url)
+        if key not in seen:
+            seen.add(key)
             urls.append(url)
     return urls
 
 
-def acu_headers(token: str) -> Dict[str, str]:
-    return {
-        "X-Auth": token,
-        "Accept": "application/json",
-        "Content-Type": "application/json",
-    }
-
-
-def acu_list_groups(s: requests.Session, base_url: str, token: str, timeout: int) -> List[Dict[str, Any]]:
-    r = s.get(f"{base_url.rstrip('/')}/api/v1/target_groups?limit=100", headers=acu_headers(token), timeout=timeout)
-    r.raise_for_status()
-    return r.json().get("groups", [])
-
-
-def acu_find_group_by_name(groups: List[Dict[str, Any]], name: str) -> Optional[Dict[str, Any]]:
-    for g in groups:
-        if g.get("name") == name:
-            return g
-    return None
-
-
-def acu_create_group(s: requests.Session, base_url: str, token: str, name: str, desc: str, timeout: int) -> Dict[str, Any]:
+def acu_create_group(s: requests.Session, base: str, name: str, desc: str, timeout: int) -> Dict[str, Any]:
     payload = {"name": name, "description": desc}
-    r = s.post(f"{base_url.rstrip('/')}/api/v1/target_groups", headers=acu_headers(token), json=payload, timeout=timeout)
+    r = s.post(f"{base}/api/v1/target_groups", json=payload, timeout=timeout)
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
 
 
-def acu_group_target_ids(s: requests.Session, base_url: str, token: str, group_id: str, timeout: int) -> List[str]:
-    r = s.get(f"{base_url.rstrip('/')}/api/v1/target_groups/{group_id}/targets", headers=acu_headers(token), timeout=timeout)
+def acu_get_group_target_ids(s: requests.Session, base: str, group_id: str, timeout: int) -> List[str]:
+    r = s.get(f"{base}/api/v1/target_groups/{group_id}/targets", timeout=timeout)
     r.raise_for_status()
-    return r.json().get("target_id_list", [])
+    return json_loads(r.content).get("target_id_list", [])
 
 
-def acu_get_target(s: requests.Session, base_url: str, token: str, target_id: str, timeout: int) -> Dict[str, Any]:
-    r = s.get(f"{base_url.rstrip('/')}/api/v1/targets/{target_id}", headers=acu_headers(token), timeout=timeout)
+def acu_get_target(s: requests.Session, base: str, target_id: str, timeout: int) -> Dict[str, Any]:
+    r = s.get(f"{base}/api/v1/targets/{target_id}", timeout=timeout)
     r.raise_for_status()
-    return r.json()
+    return json_loads(r.content)
+
+
+def acu_list_targets_by_group(
+    s: requests.Session, base: str, group_id: str, timeout: int, page_size: int = 100, concurrency: int = 8
+) -> List[Dict[str, Any]]:
+    # The group's id list is authoritative; the filtered listing only saves the per-target GETs.
+    wanted = set(acu_get_group_target_ids(s, base, group_id, timeout))
+    if not wanted:
+        return []
+    targets: Dict[str, Dict[str, Any]] = {}
+    cursor: Optional[str] = None
+    while len(targets) < len(wanted):
+        params: Dict[str, Any] = {"l": page_size, "q": f"group_id:{group_id}"}
+        if cursor is not None:
+            params["c"] = cursor
+        r = s.get(f"{base}/api/v1/targets", params=params, timeout=timeout)
+        r.raise_for_status()
+        body = json_loads(r.content)
+        page = body.get("targets", [])
+        for t in page:
+            tid = t.get("target_id")
+            if tid in wanted:
+                targets[tid] = t
+        next_cursor = (body.get("pagination") or {}).get("next_cursor")
+        if not page or next_cursor is None or next_cursor == cursor:
+            break
+        cursor = next_cursor
+    # Versions that ignore the q filter or the cursor leave gaps; fetch those targets one by one.
+    missing = [tid for tid in wanted if tid not in targets]
+    if missing:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(missing)))) as ex:
+            for tid, t in zip(missing, ex.map(lambda tid: acu_get_target(s, base, tid, timeout), missing)):
+                targets[tid] = t
+    return list(targets.values())
 
 
-def acu_targets_add(s: requests.Session, base_url: str, token: str, group_id: str, pt_name: str, urls: List[str], timeout: int) -> Dict[str, Any]:
+def acu_targets_add(s: requests.Session, base: str, group_id: str, pt_name: str, urls: List[str], timeout: int) -> Dict[str, Any]:
     targets = [{"addressValue": u, "address": u, "description": pt_name, "web_asset_id": ""} for u in urls]
     payload = {"targets": targets, "groups": [group_id]}
-    r = s.post(f"{base_url.rstrip('/')}/api/v1/targets/add", headers=acu_headers(token), json=payload, timeout=timeout)
+    r = s.post(f"{base}/api/v1/targets/add", json=payload, timeout=timeout)
     body: Dict[str, Any]
     try:
-        body = r.json()
-    except Exception:
+        body = json_loads(r.content)
+    except ValueError:
         body = {"_raw": r.text}
     return {"status": r.status_code, "response": body}
 
 
+def acu_targets_add_batched(
+    s: requests.Session,
+    base: str,
+    group_id: str,
+    pt_name: str,
+    urls: List[str],
+    timeout: int,
+    batch_size: int = 500,
+    concurrency: int = 4,
+) -> List[Dict[str, Any]]:
+    def add_batch(batch: List[str]) -> Dict[str, Any]:
+        try:
+            res = acu_targets_add(s, base, group_id, pt_name, batch, timeout)
+        except requests.RequestException as e:
+            res = {"status": None, "error": str(e)}
+        res["count"] = len(batch)
+        return res
+
+    batches = [urls[i : i + batch_size] for i in range(0, len(urls), batch_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(batches)))) as ex:
+        return list(ex.map(add_batch, batches))
+
+
 def build_parser() -> argparse.ArgumentParser:
     ap = argparse.ArgumentParser()
     ap.add_argument("--base-url", "--dojo-base-url", dest="base_url", default=os.environ.get("DOJO_BASE_URL"))
@@ -156,7 +229,10 @@ def build_parser() -> argparse.ArgumentParser:
     ap.add_argument("--acu-base-url", default=os.environ.get("ACUNETIX_BASE_URL"))
     ap.add_argument("--acu-token", "--acu-api-token", dest="acu_token", default=os.environ.get("ACUNETIX_API_TOKEN"))
     ap.add_argument("--timeout", type=int, default=30)
+    ap.add_argument("--groups-cache-ttl", type=int, default=300, help="Seconds to reuse the cached target_groups listing (0 disables)")
+    ap.add_argument("--concurrency", type=int, default=8, help="Max parallel Dojo page fetches")
     ap.add_argument("--output", help="Optional path to write result JSON")
+    ap.add_argument("--pretty", action="store_true", help="Indent the --output file")
     ap.add_argument("--dry-run", action="store_true")
     return ap
 
@@ -172,22 +248,22 @@ def main() -> int:
             missing.append(key)
     if missing:
         result["errors"].append({"code": "missing_required", "details": missing})
-        if args.output:
-            with open(args.output, "w", encoding="utf-8") as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
-        print(json.dumps(result, ensure_ascii=False))
+        emit(result, args.output, args.pretty)
         return 2
     if args.timeout <= 0:
         result["errors"].append({"code": "invalid_timeout"})
-        print(json.dumps(result, ensure_ascii=False))
+        emit(result)
         return 2
 
     try:
-        dojo_s = make_session(verify=True)
-        pt = dojo_get_product_type(dojo_s, args.base_url, args.token, args.pt_id, args.timeout)
+        dojo_base = args.base_url.rstrip("/")
+        dojo_s = make_session(verify=True, pool=max(32, args.concurrency), headers=dojo_headers(args.token))
+        pt = dojo_get_product_type(dojo_s, dojo_base, args.pt_id, args.timeout)
         pt_name = pt.get("name") or f"PT-{args.pt_id}"
 
-        products = dojo_get_products_for_pt(dojo_s, args.base_url, args.token, args.pt_id, args.timeout)
+        products = dojo_get_products_for_pt(
+            dojo_s, dojo_base, args.pt_id, args.timeout, concurrency=args.concurrency
+        )
         urls = build_targets_from_products(products)
         result["metrics"].update({
             "dojo_products_total": len(products),
@@ -199,12 +275,12 @@ def main() -> int:
             result["status"] = "skipped"
             result["warnings"].append("no_internet_accessible_targets")
             result["timestamps"]["finished_at"] = now_iso()
-            print(json.dumps(result, ensure_ascii=False))
+            emit(result)
             return 0
 
-        acu_s = make_session(verify=False)
-        groups = acu_list_groups(acu_s, args.acu_base_url, args.acu_token, args.timeout)
-        g = acu_find_group_by_name(groups, pt_name)
+        acu_s = make_session(verify=False, headers=acu_headers(args.acu_token))
+        acu_base = args.acu_base_url.rstrip("/")
+        g, _ = acu_resolve_group(acu_s, acu_base, args.acu_token, pt_name, args.timeout, args.groups_cache_ttl)
 
         group_created = False
         if g:
@@ -215,36 +291,33 @@ def main() -> int:
         else:
             created = acu_create_group(
                 acu_s,
-                args.acu_base_url,
-                args.acu_token,
+                acu_base,
                 pt_name,
                 f"Dojo PT #{pt.get('id')} ({pt_name})",
                 args.timeout,
             )
             group_id = created.get("group_id")
             group_created = True
+            invalidate_groups_cache(acu_base, args.acu_token)
 
         if not group_id:
             raise RuntimeError("group_id_resolution_failed")
 
-        desired = set(urls)
         existing: Set[str] = set()
-        target_ids = [] if args.dry_run else acu_group_target_ids(acu_s, args.acu_base_url, args.acu_token, group_id, args.timeout)
-        for tid in target_ids:
-            t = acu_get_target(acu_s, args.acu_base_url, args.acu_token, tid, args.timeout)
+        targets = [] if args.dry_run else acu_list_targets_by_group(acu_s, acu_base, group_id, args.timeout)
+        for t in targets:
             addr = t.get("address") or t.get("target") or ""
             norm = normalize_target_url(addr)
             if norm:
-                existing.add(norm)
+                existing.add(target_key(norm))
 
-        to_add = sorted(desired - existing)
-        skipped_existing = sorted(desired & existing)
+        to_add = [u for u in urls if target_key(u) not in existing]
 
         result["metrics"].update({
             "group_id": group_id,
             "group_created": group_created,
             "targets_existing_count": len(existing),
-            "targets_skipped_count": len(skipped_existing),
+            "targets_skipped_count": len(urls) - len(to_add),
             "targets_to_add_count": len(to_add),
         })
 
@@ -255,31 +328,37 @@ def main() -> int:
             result["status"] = "skipped"
             result["metrics"]["reason"] = "no_changes"
         else:
-            add_result = acu_targets_add(acu_s, args.acu_base_url, args.acu_token, group_id, pt_name, to_add, args.timeout)
-            if add_result["status"] not in (200, 201):
-                raise RuntimeError(f"targets_add_failed: {add_result['status']}")
-            result["status"] = "success"
-            result["metrics"]["targets_added_count"] = len(to_add)
-
-        result["ok"] = True
+            add_results = acu_targets_add_batched(acu_s, acu_base, group_id, pt_name, to_add, args.timeout)
+            # Batches that went through are reported even when others failed; their targets exist now.
+            failed = [res for res in add_results if res["status"] not in (200, 201)]
+            added_count = sum(res["count"] for res in add_results if res["status"] in (200, 201))
+            result["metrics"].update({
+                "targets_add_batches": len(add_results),
+                "targets_add_batches_failed": len(failed),
+                "targets_added_count": added_count,
+            })
+            if failed:
+                result["status"] = "partial" if added_count else "error"
+                result["errors"].append({"code": "targets_add_failed", "details": failed})
+            else:
+                result["status"] = "success"
+
+        result["ok"] = not result["errors"]
         result["timestamps"]["finished_at"] = now_iso()
-        if args.output:
-            with open(args.output, "w", encoding="utf-8") as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
-        print(json.dumps(result, ensure_ascii=False))
-        return 0
+        emit(result, args.output, args.pretty)
+        return 0 if result["ok"] else 1
 
     except Exception as e:
         result["ok"] = False
         result["status"] = "error"
         result["errors"].append({"code": "unexpected_error", "details": str(e), "traceback": traceback.format_exc()})
         result["timestamps"]["finished_at"] = now_iso()
-        if args.output:
-            with open(args.output, "w", encoding="utf-8") as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
-        print(json.dumps(result, ensure_ascii=False))
+        emit(result, args.output, args.pretty)
         return 1
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    code = main()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
@@ -2,18 +2,48 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import concurrent.futures
+import contextlib
+import functools
 import hashlib
 import json
 import os
+import re
 import sys
+import time
 from datetime import datetime, timezone
 from typing import Any, Dict, List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is used when it is not installed
+    orjson = None
 
 STATE_PREFIX = "autojp_state:"
 STAGES = ["WF_A", "WF_B", "WF_C", "WF_D"]
 SUCCESS_STATUSES = {"success", "skipped", "no_changes", "already_running"}
+_STATE_LINE_RE = re.compile(rf"(?m)^{re.escape(STATE_PREFIX)}.*$\n?")
+# A PT whose worker starts later than this after the batch prefetch re-reads its description and state.
+PREFETCH_MAX_AGE = 30.0
+
+
+def json_loads(data: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def emit(result: Any) -> None:
+    sys.stdout.buffer.write(json_dumps(result) + b"\n")
 
 
 def now_iso() -> str:
@@ -36,19 +66,25 @@ def default_result() -> Dict[str, Any]:
 
 
 def read_state_from_description(description: str) -> Dict[str, Any]:
-    for line in (description or "").splitlines():
-        if line.startswith(STATE_PREFIX):
-            try:
-                return json.loads(line[len(STATE_PREFIX) :].strip())
-            except Exception:
-                return {}
-    return {}
+    if not description:
+        return {}
+    if description.startswith(STATE_PREFIX):
+        start = len(STATE_PREFIX)
+    else:
+        i = description.find("\n" + STATE_PREFIX)
+        if i < 0:
+            return {}
+        start = i + 1 + len(STATE_PREFIX)
+    end = description.find("\n", start)
+    try:
+        return json_loads(description[start : end if end >= 0 else None].strip())
+    except Exception:
+        return {}
 
 
 def write_state_to_description(description: str, state: Dict[str, Any]) -> str:
-    lines = [line for line in (description or "").splitlines() if not line.startswith(STATE_PREFIX)]
-    lines.append(f"{STATE_PREFIX}{json.dumps(state, ensure_ascii=False, separators=(',', ':'))}")
-    return "\n".join(lines).strip()
+    cleaned = _STATE_LINE_RE.sub("", description or "")
+    return f"{cleaned.rstrip()}\n{STATE_PREFIX}{json_dumps(state).decode('utf-8')}".strip()
 
 
 def dojo_headers(token: str) -> Dict[str, str]:
@@ -59,22 +95,46 @@ def dojo_headers(token: str) -> Dict[str, str]:
     }
 
 
-def get_product_type(base_url: str, token: str, pt_id: int, timeout: int) -> Dict[str, Any]:
-    r = requests.get(f"{base_url.rstrip('/')}/product_types/{pt_id}/", headers=dojo_headers(token), timeout=timeout)
+def make_session(pool: int = 32, headers: Optional[Dict[str, str]] = None) -> requests.Session:
+    # No automatic retries: re-sending an execute POST would start the workflow twice.
+    s = requests.Session()
+    if headers:
+        s.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=pool, pool_maxsize=pool)
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    return s
+
+
+def get_product_type(s: requests.Session, base_url: str, pt_id: int, timeout: int) -> Dict[str, Any]:
+    r = s.get(f"{base_url}/product_types/{pt_id}/", timeout=timeout)
+    r.raise_for_status()
+    return json_loads(r.content)
+
+
+def get_product_types(s: requests.Session, base_url: str, pt_ids: List[int], timeout: int) -> Dict[int, Dict[str, Any]]:
+    wanted = set(pt_ids)
+    r = s.get(
+        f"{base_url}/product_types/",
+        params={"id__in": ",".join(map(str, pt_ids)), "limit": max(len(pt_ids), 1)},
+        timeout=timeout,
+    )
     r.raise_for_status()
-    return r.json()
+    # Only keep the requested IDs in case the server ignores the filter; missing ones are fetched one by one.
+    return {pt["id"]: pt for pt in json_loads(r.content).get("results", []) if pt.get("id") in wanted}
 
 
-def patch_product_type_state(base_url: str, token: str, pt_id: int, state: Dict[str, Any], timeout: int) -> None:
-    pt = get_product_type(base_url, token, pt_id, timeout)
-    payload = {"description": write_state_to_description(pt.get("description") or "", state)}
-    p = requests.patch(
-        f"{base_url.rstrip('/')}/product_types/{pt_id}/",
-        headers=dojo_headers(token),
+def patch_product_type_state(
+    s: requests.Session, base_url: str, pt_id: int, description: str, state: Dict[str, Any], timeout: int
+) -> str:
+    payload = {"description": write_state_to_description(description, state)}
+    p = s.patch(
+        f"{base_url}/product_types/{pt_id}/",
         json=payload,
         timeout=timeout,
     )
     p.raise_for_status()
+    return payload["description"]
 
 
 def normalize_workflow_result(raw: Any, fallback_stage: str, pt_id: int) -> Dict[str, Any]:
@@ -87,14 +147,17 @@ def normalize_workflow_result(raw: Any, fallback_stage: str, pt_id: int) -> Dict
         if isinstance(raw.get("json"), dict):
             candidate = raw["json"]
         if isinstance(candidate, dict) and "ok" in candidate and "status" in candidate:
-            candidate.setdefault("stage", fallback_stage)
-            candidate.setdefault("product_type_id", pt_id)
-            candidate.setdefault("metrics", {})
-            candidate.setdefault("errors", [])
-            candidate.setdefault("warnings", [])
-            candidate.setdefault("timestamps", {"started_at": now_iso(), "finished_at": now_iso()})
-            candidate.setdefault("product_id", None)
-            return candidate
+            ts = now_iso()
+            defaults = {
+                "stage": fallback_stage,
+                "product_type_id": pt_id,
+                "metrics": {},
+                "errors": [],
+                "warnings": [],
+                "timestamps": {"started_at": ts, "finished_at": ts},
+                "product_id": None,
+            }
+            return {**defaults, **candidate}
     out = default_result()
     out["stage"] = fallback_stage
     out["product_type_id"] = pt_id
@@ -109,18 +172,18 @@ def build_n8n_headers(api_key: str) -> Dict[str, str]:
 
 
 def execute_workflow(
+    s: requests.Session,
     n8n_base_url: str,
-    n8n_api_key: str,
     workflow_id: str,
     payload: Dict[str, Any],
     timeout: int,
 ) -> Tuple[Dict[str, Any], Dict[str, Any]]:
     # n8n API: POST /api/v1/workflows/{id}/execute
-    url = f"{n8n_base_url.rstrip('/')}/api/v1/workflows/{workflow_id}/execute"
+    url = f"{n8n_base_url}/api/v1/workflows/{workflow_id}/execute"
     req = {"workflowData": None, "input": [payload], "waitTillCompletion": True}
-    r = requests.post(url, headers=build_n8n_headers(n8n_api_key), json=req, timeout=timeout)
+    r = s.post(url, json=req, timeout=timeout)
     r.raise_for_status()
-    body = r.json()
+    body = json_loads(r.content)
     normalized = normalize_workflow_result(body, payload.get("stage") or "WF_UNKNOWN", int(payload["product_type_id"]))
     return normalized, body
 
@@ -138,11 +201,107 @@ def next_stage(state: Dict[str, Any]) -> Optional[str]:
 
 
 def input_hash_for_pt(pt: Dict[str, Any]) -> str:
-    marker = {
-        "name": pt.get("name"),
-        "updated": pt.get("updated") or pt.get("updated_at") or "",
-    }
-    return hashlib.sha256(json.dumps(marker, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+    marker = f"{pt.get('name') or ''}\x1f{pt.get('updated') or pt.get('updated_at') or ''}"
+    return hashlib.sha256(marker.encode("utf-8")).hexdigest()
+
+
+def process_pt(
+    dojo_s: requests.Session,
+    n8n_s: requests.Session,
+    args: argparse.Namespace,
+    stage_to_id: Dict[str, Optional[str]],
+    prefetched: Dict[int, Dict[str, Any]],
+    prefetched_at: float,
+    pt_id: int,
+) -> Dict[str, Any]:
+    item: Dict[str, Any] = {"product_type_id": pt_id, "status": "skipped", "steps": []}
+    unsaved = False  # stages advanced since the last PATCH
+    try:
+        # PTs queued behind long pipelines must not start from (and later PATCH over) an hours-old snapshot.
+        pt = prefetched.get(pt_id) if time.monotonic() - prefetched_at < PREFETCH_MAX_AGE else None
+        if pt is None:
+            pt = get_product_type(dojo_s, args.base_url, pt_id, args.timeout)
+        description = pt.get("description") or ""
+        state = read_state_from_description(description)
+        state.setdefault("current_stage", None)
+        state.setdefault("last_success_stage", None)
+        state.setdefault("last_run_at", None)
+        state.setdefault("last_error", None)
+        state.setdefault("retry_count", 0)
+        state["input_hash"] = input_hash_for_pt(pt)
+
+        # Run until pipeline completes or an error occurs.
+        while True:
+            stage = state.get("current_stage")
+            if not stage:
+                stage = STAGES[0]
+            wf_id = stage_to_id.get(stage)
+            if not wf_id:
+                item["status"] = "error"
+                item["steps"].append({"stage": stage, "status": "error", "error": "workflow_id_not_set"})
+                state["last_error"] = {"code": "workflow_id_not_set", "stage": stage}
+                break
+
+            now = datetime.now(timezone.utc)
+            payload = {
+                "product_type_id": pt_id,
+                "run_id": f"pt-{pt_id}-{int(now.timestamp())}",
+                "trace_id": f"master-{pt_id}-{now:%Y%m%d%H%M%S}",
+                "stage": stage,
+            }
+            step_result, raw = execute_workflow(
+                n8n_s,
+                args.n8n_base_url,
+                wf_id,
+                payload,
+                args.timeout,
+            )
+
+            step_status = step_result.get("status", "error")
+            step_ok = bool(step_result.get("ok")) and step_status in SUCCESS_STATUSES
+            item["steps"].append({"stage": stage, "status": step_status, "raw": raw})
+            state["last_run_at"] = now_iso()
+            if (step_result.get("metrics") or {}).get("updated_description"):
+                # WF_B rewrites the description itself; re-read it so the next PATCH does not clobber that.
+                description = get_product_type(dojo_s, args.base_url, pt_id, args.timeout).get("description") or ""
+
+            if step_ok:
+                state["last_success_stage"] = stage
+                state["last_error"] = None
+                state["retry_count"] = 0
+                nxt = next_stage({"current_stage": stage})
+                if nxt is None:
+                    item["status"] = "success"
+                    state["current_stage"] = None
+                    break
+                state["current_stage"] = nxt
+                if args.checkpoint_every_stage:
+                    description = patch_product_type_state(dojo_s, args.base_url, pt_id, description, state, args.timeout)
+                else:
+                    unsaved = True
+                continue
+
+            state["last_error"] = {
+                "stage": stage,
+                "status": step_status,
+                "errors": step_result.get("errors", []),
+            }
+            state["retry_count"] = int(state.get("retry_count", 0)) + 1
+            state["current_stage"] = stage
+            item["status"] = "error"
+            break
+
+        patch_product_type_state(dojo_s, args.base_url, pt_id, description, state, args.timeout)
+    except Exception as exc:
+        item["status"] = "error"
+        item["steps"].append({"stage": "WF_MASTER", "status": "error", "details": str(exc)})
+        if unsaved:
+            # Keep the progress a per-stage checkpoint would have saved. The failed stage may already have
+            # rewritten the description (WF_B), so merge into a fresh copy; skip the write if it cannot be read.
+            with contextlib.suppress(Exception):
+                current = get_product_type(dojo_s, args.base_url, pt_id, args.timeout).get("description") or ""
+                patch_product_type_state(dojo_s, args.base_url, pt_id, current, state, args.timeout)
+    return item
 
 
 def main() -> int:
@@ -157,7 +316,11 @@ def main() -> int:
     ap.add_argument("--wf-c-id", default=os.environ.get("N8N_WF_C_ID"))
     ap.add_argument("--wf-d-id", default=os.environ.get("N8N_WF_D_ID"))
     ap.add_argument("--timeout", type=int, default=60)
+    ap.add_argument("--concurrency", type=int, default=4, help="Max product types processed in parallel")
+    ap.add_argument("--checkpoint-every-stage", action="store_true", help="PATCH the PT state after each successful stage")
     args = ap.parse_args()
+    args.base_url = (args.base_url or "").rstrip("/")
+    args.n8n_base_url = args.n8n_base_url.rstrip("/")
 
     stage_to_id = {
         "WF_A": args.wf_a_id,
@@ -187,82 +350,24 @@ def main() -> int:
         result["status"] = "error"
         result["errors"].append(err)
         result["timestamps"]["finished_at"] = now_iso()
-        print(json.dumps(result, ensure_ascii=False))
+        emit(result)
         return 1
 
     ids = [int(x.strip()) for x in args.product_type_ids.split(",") if x.strip()]
 
-    for pt_id in ids:
-        item: Dict[str, Any] = {"product_type_id": pt_id, "status": "skipped", "steps": []}
-        try:
-            pt = get_product_type(args.base_url, args.token, pt_id, args.timeout)
-            state = read_state_from_description(pt.get("description") or "")
-            state.setdefault("current_stage", None)
-            state.setdefault("last_success_stage", None)
-            state.setdefault("last_run_at", None)
-            state.setdefault("last_error", None)
-            state.setdefault("retry_count", 0)
-            state["input_hash"] = input_hash_for_pt(pt)
-
-            # Run until pipeline completes or an error occurs.
-            while True:
-                stage = state.get("current_stage")
-                if not stage:
-                    stage = STAGES[0]
-                wf_id = stage_to_id.get(stage)
-                if not wf_id:
-                    item["status"] = "error"
-                    item["steps"].append({"stage": stage, "status": "error", "error": "workflow_id_not_set"})
-                    state["last_error"] = {"code": "workflow_id_not_set", "stage": stage}
-                    break
-
-                payload = {
-                    "product_type_id": pt_id,
-                    "run_id": f"pt-{pt_id}-{int(datetime.now(timezone.utc).timestamp())}",
-                    "trace_id": f"master-{pt_id}-{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}",
-                    "stage": stage,
-                }
-                step_result, raw = execute_workflow(
-                    args.n8n_base_url,
-                    args.n8n_api_key,
-                    wf_id,
-                    payload,
-                    args.timeout,
-                )
-
-                step_status = step_result.get("status", "error")
-                step_ok = bool(step_result.get("ok")) and step_status in SUCCESS_STATUSES
-                item["steps"].append({"stage": stage, "status": step_status, "raw": raw})
-                state["last_run_at"] = now_iso()
-
-                if step_ok:
-                    state["last_success_stage"] = stage
-                    state["last_error"] = None
-                    state["retry_count"] = 0
-                    nxt = next_stage({"current_stage": stage})
-                    if nxt is None:
-                        item["status"] = "success"
-                        state["current_stage"] = None
-                        break
-                    state["current_stage"] = nxt
-                    patch_product_type_state(args.base_url, args.token, pt_id, state, args.timeout)
-                    continue
-
-                state["last_error"] = {
-                    "stage": stage,
-                    "status": step_status,
-                    "errors": step_result.get("errors", []),
-                }
-                state["retry_count"] = int(state.get("retry_count", 0)) + 1
-                state["current_stage"] = stage
-                item["status"] = "error"
-                break
-
-            patch_product_type_state(args.base_url, args.token, pt_id, state, args.timeout)
-        except Exception as exc:
-            item["status"] = "error"
-            item["steps"].append({"stage": "WF_MASTER", "status": "error", "details": str(exc)})
-
+    pool = max(32, args.concurrency)
+    dojo_s = make_session(pool=pool, headers=dojo_headers(args.token))
+    n8n_s = make_session(pool=pool, headers=build_n8n_headers(args.n8n_api_key))
+    prefetched_at = time.monotonic()
+    try:
+        prefetched = get_product_types(dojo_s, args.base_url, ids, args.timeout) if ids else {}
+    except Exception:
+        prefetched = {}
+        result["warnings"].append("product_types_batch_failed")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as ex:
+        items = list(ex.map(functools.partial(process_pt, dojo_s, n8n_s, args, stage_to_id, prefetched, prefetched_at), ids))
+
+    for item in items:
         if item["status"] == "error":
             result["ok"] = False
             result["metrics"]["failed"] += 1
@@ -271,9 +376,12 @@ def main() -> int:
     result["metrics"]["processed"] = len(result["items"])
     result["status"] = "success" if result["ok"] else "error"
     result["timestamps"]["finished_at"] = now_iso()
-    print(json.dumps(result, ensure_ascii=False))
+    emit(result)
     return 0 if result["ok"] else 1
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    code = main()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
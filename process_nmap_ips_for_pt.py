@@ -8,18 +8,34 @@ Outputs a stable JSON object to stdout and optionally to --output.
 """
 
 import argparse
-import json
+import concurrent.futures
+import contextlib
+import functools
 import os
 import sys
+import tempfile
 import xml.etree.ElementTree as ET
 from datetime import datetime, timezone
 from ipaddress import ip_address
-from typing import Dict, List, Set, Tuple
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from lxml import etree as LET
+except ImportError:  # optional speedup; ElementTree is used when lxml is not installed
+    LET = None
+
+from acunetix_lib import dojo_headers, emit, json_dumps, json_loads, make_retry
 
 STAGE = "WF_B"
 
+HTTPISH_SERVICES = frozenset({"http", "https", "ssl/http", "http-alt", "https-alt"})
+HTTPISH_PORTS = frozenset({81, 3000, 5000, 5601, 8000, 8080, 8081, 8443, 8888, 9000, 9443})
+TLS_PORTS = frozenset({8443, 9443})
+_IP_FIRST_CHARS = frozenset("0123456789abcdefABCDEF:")
+
 
 def now_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
@@ -73,6 +89,8 @@ def build_arg_parser() -> argparse.ArgumentParser:
     )
     p.add_argument("--exclude-ports", default=os.environ.get("EXCLUDE_PORTS", "80,443"))
     p.add_argument("--timeout", type=int, default=30, help="HTTP timeout in seconds")
+    p.add_argument("--concurrency", type=int, default=8, help="Max parallel Dojo requests (page fetches and product creation)")
+    p.add_argument("--no-parse-cache", action="store_true", help="Re-parse every nmap XML file")
     p.add_argument("--output", help="Optional path to write result JSON")
     p.add_argument("--dry-run", action="store_true")
     return p
@@ -80,11 +98,15 @@ def build_arg_parser() -> argparse.ArgumentParser:
 
 # ---------- helpers ----------
 
+@functools.lru_cache(maxsize=8192)
 def looks_like_ip(s: str) -> bool:
+    # Domain names almost never start like an address; skip the raising ip_address() call for them.
+    if not s or s[0] not in _IP_FIRST_CHARS:
+        return False
     try:
         ip_address(s)
         return True
-    except Exception:
+    except ValueError:
         return False
 
 
@@ -95,102 +117,190 @@ def strip_www(host: str) -> str:
     return host
 
 
-def parse_nmap_xml_for_ips(filename: str, exclude_ports: Set[int]) -> List[Tuple[str, int, str]]:
-    if not os.path.exists(filename):
+def host_web_ports(host, exclude_ports: FrozenSet[int]) -> List[Tuple[str, int, str]]:
+    status_el = host.find("status")
+    if status_el is not None and status_el.get("state") != "up":
         return []
-    try:
-        tree = ET.parse(filename)
-    except ET.ParseError:
+
+    addr = host.find("address")
+    if addr is None:
+        return []
+    ip_addr = addr.get("addr", "")
+    if not ip_addr or not looks_like_ip(ip_addr):
+        return []
+
+    ports = host.find("ports")
+    if ports is None:
         return []
 
-    root = tree.getroot()
     result: List[Tuple[str, int, str]] = []
-    for host in root.findall("host"):
-        status_el = host.find("status")
-        if status_el is not None and status_el.get("state") != "up":
+    for p in ports.iterfind("port"):
+        state = p.find("state")
+        if state is None or state.get("state") != "open":
             continue
-
-        addr = host.find("address")
-        if addr is None:
+        try:
+            portnum = int(p.get("portid", "0"))
+        except Exception:
             continue
-        ip_addr = addr.get("addr", "")
-        if not ip_addr or not looks_like_ip(ip_addr):
+        if portnum <= 0 or portnum in exclude_ports:
             continue
 
-        ports = host.find("ports")
-        if ports is None:
-            continue
+        svc = p.find("service")
+        svc_name = (svc.get("name", "") if svc is not None else "").lower()
+        svc_tunnel = (svc.get("tunnel", "") if svc is not None else "").lower()
+
+        if svc_name in HTTPISH_SERVICES or portnum in HTTPISH_PORTS:
+            proto = "https" if ("ssl" in svc_tunnel or portnum in TLS_PORTS) else "http"
+            result.append((ip_addr, portnum, proto))
+
+    return result
+
 
-        for p in ports.findall("port"):
-            state = p.find("state")
-            if state is None or state.get("state") != "open":
-                continue
+def parse_nmap_xml_for_ips(filename: str, exclude_ports: FrozenSet[int]) -> List[Tuple[str, int, str]]:
+    try:
+        f = open(filename, "rb", buffering=1 << 20)
+    except FileNotFoundError:
+        return []
+    with f:
+        if LET is None:
             try:
-                portnum = int(p.get("portid", "0"))
-            except Exception:
-                continue
-            if portnum <= 0 or portnum in exclude_ports:
-                continue
-
-            svc = p.find("service")
-            svc_name = (svc.get("name", "") if svc is not None else "").lower()
-            svc_tunnel = (svc.get("tunnel", "") if svc is not None else "").lower()
-
-            if svc_name in {"http", "https", "ssl/http", "http-alt", "https-alt"} or portnum in {
-                81,
-                3000,
-                5000,
-                5601,
-                8000,
-                8080,
-                8081,
-                8443,
-                8888,
-                9000,
-                9443,
-            }:
-                proto = "https" if ("ssl" in svc_tunnel or portnum in (8443, 9443)) else "http"
-                result.append((ip_addr, portnum, proto))
+                tree = ET.parse(f)
+            except ET.ParseError:
+                return []
+            result: List[Tuple[str, int, str]] = []
+            for host in tree.getroot().findall("host"):
+                result.extend(host_web_ports(host, exclude_ports))
+            return result
+
+        # Stream hosts and drop each one once handled so large scans are not held in memory.
+        result = []
+        try:
+            for _, host in LET.iterparse(f, events=("end",), tag="host"):
+                result.extend(host_web_ports(host, exclude_ports))
+                host.clear()
+                while host.getprevious() is not None:
+                    del host.getparent()[0]
+        except LET.XMLSyntaxError:
+            return []
+        return result
+
+
+def parse_cache_path(xml_dir: str, pt_id: int) -> str:
+    # Kept inside xml_dir: whoever can write the cache can already write the XML it summarizes.
+    # One file per PT, so runs for different PTs neither evict nor overwrite each other's entries.
+    return os.path.join(xml_dir, f".nmap_parse_cache_pt{pt_id}.json")
+
 
+def load_parse_cache(path: str) -> Dict[str, Any]:
+    try:
+        with open(path, "rb") as f:
+            cache = json_loads(f.read())
+    except (OSError, ValueError):
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+
+def cached_hits(entry: Dict[str, Any], exclude_ports: FrozenSet[int]) -> Optional[List[Tuple[str, int, str]]]:
+    # Hits become Dojo products and scan targets; anything but well-formed triples counts as a miss.
+    hits = entry.get("hits")
+    if not isinstance(hits, list):
+        return None
+    result: List[Tuple[str, int, str]] = []
+    for hit in hits:
+        if not isinstance(hit, list) or len(hit) != 3:
+            return None
+        ip_addr, portnum, proto = hit
+        if not isinstance(ip_addr, str) or not looks_like_ip(ip_addr):
+            return None
+        if type(portnum) is not int or not 0 < portnum < 65536 or portnum in exclude_ports:
+            return None
+        if proto not in ("http", "https"):
+            return None
+        result.append((ip_addr, portnum, proto))
     return result
 
 
+def write_parse_cache(path: str, cache: Dict[str, Any]) -> None:
+    try:
+        fd, tmp_path = tempfile.mkstemp(prefix=".nmap_parse_", suffix=".tmp", dir=os.path.dirname(path))
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(json_dumps(cache))
+        os.replace(tmp_path, path)
+    except OSError:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_path)
+
+
 # ---------- API client ----------
 
 class DojoClient:
-    def __init__(self, base_url: str, token: str, timeout: int, dry_run: bool):
+    def __init__(self, base_url: str, token: str, timeout: int, dry_run: bool, pool: int = 32):
         self.base = base_url.rstrip("/")
         self.timeout = timeout
         self.dry_run = dry_run
-        self.headers = {
-            "Authorization": f"Token {token}",
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-        }
+        self.headers = dojo_headers(token)
+        self.s = requests.Session()
+        self.s.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool, pool_maxsize=pool, max_retries=make_retry())
+        self.s.mount("https://", adapter)
+        self.s.mount("http://", adapter)
 
     def get(self, path: str, params: dict | None = None) -> dict:
-        r = requests.get(self.base + path, headers=self.headers, params=params, timeout=self.timeout)
+        r = self.s.get(self.base + path, params=params, timeout=self.timeout)
         r.raise_for_status()
-        return r.json()
+        return json_loads(r.content)
 
     def post(self, path: str, payload: dict) -> dict:
         if self.dry_run:
             return {"_dry_run": True, "path": path, "payload": payload}
-        r = requests.post(self.base + path, headers=self.headers, json=payload, timeout=self.timeout)
+        r = self.s.post(self.base + path, data=json_dumps(payload), timeout=self.timeout)
         r.raise_for_status()
-        return r.json()
+        return json_loads(r.content)
 
     def patch(self, path: str, payload: dict) -> dict:
         if self.dry_run:
             return {"_dry_run": True, "path": path, "payload": payload}
-        r = requests.patch(self.base + path, headers=self.headers, json=payload, timeout=self.timeout)
+        r = self.s.patch(self.base + path, data=json_dumps(payload), timeout=self.timeout)
         r.raise_for_status()
-        return r.json()
+        return json_loads(r.content)
 
 
 # ---------- core ----------
 
-def process_single_product_type(client: DojoClient, pt_id: int, xml_dir: str, exclude_ports: Set[int]) -> dict:
+def is_already_exists(resp: Optional[requests.Response]) -> bool:
+    # Dojo rejects a duplicate product name with 400 "... already exists"; some proxies map it to 409.
+    if resp is None:
+        return False
+    return resp.status_code == 409 or (resp.status_code == 400 and "already exists" in resp.text)
+
+
+def get_products_for_pt(client: DojoClient, pt_id: int, limit: int = 1000, concurrency: int = 8) -> List[dict]:
+    def fetch_page(offset: int) -> dict:
+        return client.get("/products/", params={"prod_type": pt_id, "limit": limit, "offset": offset})
+
+    # The first page carries the total count, so the remaining offsets can be fetched in parallel.
+    first = fetch_page(0)
+    products: List[dict] = list(first.get("results", []))
+    if not first.get("next"):
+        return products
+    offsets = range(limit, int(first.get("count") or 0), limit)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
+        for page in ex.map(fetch_page, offsets):
+            products.extend(page.get("results", []))
+    return products
+
+
+def process_single_product_type(
+    client: DojoClient,
+    pt_id: int,
+    xml_dir: str,
+    exclude_ports: FrozenSet[int],
+    concurrency: int = 8,
+    use_parse_cache: bool = True,
+) -> dict:
     summary: Dict[str, object] = contract(pt_id, "success", ok=True)
     summary["metrics"] = {
         "xml_dir": xml_dir,
@@ -204,22 +314,16 @@ def process_single_product_type(client: DojoClient, pt_id: int, xml_dir: str, ex
     pt_name = pt.get("name", f"pt_{pt_id}")
     summary["metrics"]["product_type_name"] = pt_name
 
-    products: List[dict] = []
-    limit = 100
-    offset = 0
-    while True:
-        data = client.get("/products/", params={"prod_type": pt_id, "limit": limit, "offset": offset})
-        results = data.get("results", [])
-        if not results:
-            break
-        products.extend(results)
-        if not data.get("next"):
-            break
-        offset += limit
+    products = get_products_for_pt(client, pt_id, concurrency=concurrency)
     summary["metrics"]["products_count"] = len(products)
 
+    # One directory listing instead of a stat per product; products without a scan file are skipped up front.
+    with os.scandir(xml_dir) as it:
+        xml_files = {entry.name: entry for entry in it if entry.name.startswith("nmap_") and entry.name.endswith(".xml")}
+
     existing_product_names: Set[str] = set()
     domain_hosts: Set[str] = set()
+    xml_entries: List[os.DirEntry] = []
     for p in products:
         pname = p.get("name", "")
         existing_product_names.add(pname)
@@ -227,22 +331,61 @@ def process_single_product_type(client: DojoClient, pt_id: int, xml_dir: str, ex
             host_part = pname.split(":", 1)[0]
             if host_part and not looks_like_ip(host_part):
                 domain_hosts.add(strip_www(host_part))
-
-    candidates: Dict[str, str] = {}
-    for p in products:
         pid = p.get("id")
-        if not pid:
-            continue
-        xml_path = os.path.join(xml_dir, f"nmap_{pid}.xml")
-        for ip_addr, portnum, proto in parse_nmap_xml_for_ips(xml_path, exclude_ports):
-            candidates[f"{ip_addr}:{portnum}"] = proto
-
-    created_products: List[str] = []
-    ip_lines_set: Set[str] = set()
-    for prod_name, proto in sorted(candidates.items()):
-        ip_lines_set.add(f"{proto}://{prod_name}, {pt_name}")
-        if prod_name in existing_product_names:
-            continue
+        if pid and (entry := xml_files.get(f"nmap_{pid}.xml")):
+            xml_entries.append(entry)
+
+    # Parse results are reused while a file's mtime/size (and the port exclusions) are unchanged.
+    cache_path = parse_cache_path(xml_dir, pt_id)
+    cache = load_parse_cache(cache_path) if use_parse_cache else {}
+    new_cache: Dict[str, Any] = {}
+    parsed: List[List[Tuple[str, int, str]]] = []
+    misses: List[int] = []
+    exclude_key = sorted(exclude_ports)
+    for i, entry in enumerate(xml_entries):
+        st = entry.stat()
+        key = [st.st_mtime_ns, st.st_size, exclude_key]
+        cached = cache.get(entry.path)
+        hits = cached_hits(cached, exclude_ports) if isinstance(cached, dict) and cached.get("key") == key else None
+        if hits is not None:
+            parsed.append(hits)
+        else:
+            parsed.append([])
+            misses.append(i)
+        new_cache[entry.path] = {"key": key}
+
+    parse = functools.partial(parse_nmap_xml_for_ips, exclude_ports=exclude_ports)
+    miss_paths = [xml_entries[i].path for i in misses]
+    if len(miss_paths) > 4:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(miss_paths), os.cpu_count() or 1)) as ex:
+            fresh = list(ex.map(parse, miss_paths, chunksize=8))
+    else:
+        fresh = [parse(path) for path in miss_paths]
+    for i, hits in zip(misses, fresh):
+        parsed[i] = hits
+    for entry, hits in zip(xml_entries, parsed):
+        new_cache[entry.path]["hits"] = hits
+    summary["metrics"]["xml_files_parsed"] = len(misses)
+    summary["metrics"]["xml_files_cached"] = len(xml_entries) - len(misses)
+    if use_parse_cache and (misses or new_cache.keys() != cache.keys()):
+        write_parse_cache(cache_path, new_cache)
+
+    # Keyed by (IP version, address as int, port): cheap to hash and sorts addresses numerically.
+    candidates: Dict[Tuple[int, int, int], Tuple[str, str]] = {}
+    for hits in parsed:
+        for ip_addr, portnum, proto in hits:
+            addr = ip_address(ip_addr)
+            candidates[(addr.version, int(addr), portnum)] = (f"{ip_addr}:{portnum}", proto)
+
+    # Candidates are sorted once; lines are grouped by scheme (http before https) without sorting them again.
+    ip_lines: Dict[str, List[str]] = {"http": [], "https": []}
+    to_create: List[str] = []
+    for _, (prod_name, proto) in sorted(candidates.items()):
+        ip_lines[proto].append(f"{proto}://{prod_name}, {pt_name}")
+        if prod_name not in existing_product_names:
+            to_create.append(prod_name)
+
+    def create_product(prod_name: str) -> Optional[str]:
         payload = {
             "name": prod_name,
             "prod_type": pt_id,
@@ -250,31 +393,35 @@ def process_single_product_type(client: DojoClient, pt_id: int, xml_dir: str, ex
             "internet_accessible": True,
         }
         try:
-            created = client.post("/products/", payload)
-            created_name = created.get("name", prod_name)
-            created_products.append(created_name)
-            existing_product_names.add(created_name)
+            return client.post("/products/", payload).get("name", prod_name)
         except requests.HTTPError as e:
-            created_products.append(f"{prod_name} (error: {e})")
+            if is_already_exists(e.response):
+                return None
+            return f"{prod_name} (error: {e})"
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
+        created_products = [name for name in ex.map(create_product, to_create) if name is not None]
 
     summary["metrics"]["created_ip_products"] = created_products
     summary["metrics"]["created_ip_products_count"] = len(created_products)
 
-    lines: List[str] = []
-    if pt_name and not looks_like_ip(pt_name.split(":", 1)[0]):
-        lines.append(f"https://{strip_www(pt_name.split(':', 1)[0])}, {pt_name}")
-    for host in sorted(domain_hosts):
-        lines.append(f"https://{host}, {pt_name}")
-    for line in sorted(ip_lines_set):
-        lines.append(line)
-
     seen: Set[str] = set()
     unique_lines: List[str] = []
-    for line in lines:
+
+    def add_line(line: str) -> None:
         if line and line not in seen:
             seen.add(line)
             unique_lines.append(line)
 
+    if pt_name and not looks_like_ip(pt_name.split(":", 1)[0]):
+        add_line(f"https://{strip_www(pt_name.split(':', 1)[0])}, {pt_name}")
+    for host in sorted(domain_hosts):
+        add_line(f"https://{host}, {pt_name}")
+    for line in ip_lines["http"]:
+        add_line(line)
+    for line in ip_lines["https"]:
+        add_line(line)
+
     description_text = "Acunetix targets:\n" + "\n".join(unique_lines) if unique_lines else ""
     try:
         client.patch(f"/product_types/{pt_id}/", {"description": description_text})
@@ -298,35 +445,42 @@ def main() -> int:
 
     if not args.base_url or not args.token:
         log("ERROR", "API token is required (--token or DOJO_API_TOKEN)")
-        print(json.dumps(contract(args.product_type_id, "error", ok=False) | {"errors": [{"code": "missing_required"}]}, ensure_ascii=False))
+        emit(contract(args.product_type_id, "error", ok=False) | {"errors": [{"code": "missing_required"}]})
         return 2
     if args.timeout <= 0:
         log("ERROR", "--timeout must be > 0")
-        print(json.dumps(contract(args.product_type_id, "error", ok=False) | {"errors": [{"code": "invalid_timeout"}]}, ensure_ascii=False))
+        emit(contract(args.product_type_id, "error", ok=False) | {"errors": [{"code": "invalid_timeout"}]})
         return 2
     if not os.path.isdir(args.xml_dir):
         log("ERROR", f"Input directory does not exist: {args.xml_dir}")
         c = contract(args.product_type_id, "error", ok=False)
         c["errors"].append({"code": "invalid_input_dir", "input": args.xml_dir})
-        print(json.dumps(c, ensure_ascii=False))
+        emit(c)
         return 2
 
-    exclude_ports: Set[int] = {int(p.strip()) for p in args.exclude_ports.split(",") if p.strip().isdigit()}
+    exclude_ports = frozenset(int(p.strip()) for p in args.exclude_ports.split(",") if p.strip().isdigit())
 
     try:
-        client = DojoClient(args.base_url, args.token, args.timeout, args.dry_run)
-        result = process_single_product_type(client, args.product_type_id, args.xml_dir, exclude_ports)
-        if args.output:
-            with open(args.output, "w", encoding="utf-8") as f:
-                json.dump(result, f, ensure_ascii=False, indent=2)
-        print(json.dumps(result, ensure_ascii=False))
+        client = DojoClient(args.base_url, args.token, args.timeout, args.dry_run, pool=max(32, args.concurrency))
+        result = process_single_product_type(
+            client,
+            args.product_type_id,
+            args.xml_dir,
+            exclude_ports,
+            concurrency=args.concurrency,
+            use_parse_cache=not args.no_parse_cache,
+        )
+        emit(result, args.output, pretty=True)
         return 0 if result.get("ok") else 1
     except Exception as e:
         err = contract(args.product_type_id, "error", ok=False)
         err["errors"].append({"code": "unexpected_error", "details": str(e)})
-        print(json.dumps(err, ensure_ascii=False))
+        emit(err)
         return 1
 
 
 if __name__ == "__main__":
-    sys.exit(main())
+    code = main()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)